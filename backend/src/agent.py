@@ -13,15 +13,23 @@ Day 7 – Food & Grocery Ordering Voice Agent (SQLite) - Venezuelan Food
 - Auto-simulation: Status updates every 5 seconds in background.
 """
 
+import atexit
+import contextlib
+import heapq
 import json
 import logging
 import os
+import re
+import secrets
 import sqlite3
-import uuid
+import sys
+import threading
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from datetime import datetime
-from typing import List, Optional, Annotated
+from functools import cache, partial
+from types import MappingProxyType
+from typing import Dict, List, Optional, Set, Tuple, Annotated
 
 from dotenv import load_dotenv
 from pydantic import Field
@@ -35,6 +43,7 @@ from livekit.agents import (
     cli,
     function_tool,
     RunContext,
+    tokenize,
 )
 
 from livekit.plugins import murf, silero, google, deepgram, noise_cancellation
@@ -42,22 +51,31 @@ from livekit.plugins.turn_detector.multilingual import MultilingualModel
 
 # Logging
 logger = logging.getLogger("food_agent_sqlite")
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-logger.addHandler(handler)
+# guard so a second import of this module doesn't stack another handler (and duplicate every line)
+if not logger.handlers:
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
 
 load_dotenv(".env.local")
 
 # DB config & seeding
 DB_FILE = "order_db.sqlite"
+# Venezuelan seed catalog, shipped next to this file; only read when the catalog table is empty
+CATALOG_SEED_FILE = "catalog_seed.json"
+# stored in PRAGMA user_version once seed_database() has created and seeded this schema
+# (2: money columns hold INTEGER cents)
+SCHEMA_VERSION = 2
 
 # Símbolo de moneda constante para fácil cambio si es necesario
 CURRENCY_SYMBOL = "$" 
 
 
+@cache
 def get_db_path() -> str:
-    """Return absolute path for the DB file. If __file__ is not defined (interactive), fall back to cwd."""
+    """Return absolute path for the DB file. If __file__ is not defined (interactive), fall back to cwd.
+    Resolved once per process; every new per-thread connection and the seed-file lookup reuse it."""
     try:
         base = os.path.abspath(os.path.dirname(__file__))
     except NameError:
@@ -68,222 +86,393 @@ def get_db_path() -> str:
     return os.path.join(base, DB_FILE)
 
 
-def get_conn():
-    path = get_db_path()
-    # check_same_thread=False required for async background tasks accessing DB
-    conn = sqlite3.connect(path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
+# One connection per thread (event loop thread + asyncio.to_thread workers), reused for the
+# process lifetime; SQLite itself arbitrates between writers. _DB_LOCK guards _ALL_CONNS and one-time init.
+_TLS = threading.local()
+_ALL_CONNS: List[sqlite3.Connection] = []
+_DB_LOCK = threading.RLock()
+_WAL_ENABLED = False
+
+
+def get_conn() -> sqlite3.Connection:
+    """Return this thread's connection, opening it and applying PRAGMAs on first use."""
+    conn = getattr(_TLS, "conn", None)
+    if conn is None:
+        # check_same_thread=False so the atexit hook may close it from the main thread
+        conn = sqlite3.connect(get_db_path(), check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # journal_mode is stored in the database file, so only the first connection sets it;
+        # the rest are per-connection settings and must be applied every time
+        global _WAL_ENABLED
+        with _DB_LOCK:
+            if not _WAL_ENABLED:
+                conn.execute("PRAGMA journal_mode = WAL;")
+                _WAL_ENABLED = True
+            _ALL_CONNS.append(conn)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -64000;")
+        conn.execute("PRAGMA mmap_size = 134217728;")
+        _TLS.conn = conn
     return conn
 
 
-def seed_database():
-    """Create tables and seed the Venezuelan catalog if empty."""
+@atexit.register
+def _close_connections():
+    with _DB_LOCK:
+        while _ALL_CONNS:
+            _ALL_CONNS.pop().close()
+
+
+def load_catalog_seed() -> List[dict]:
+    with open(os.path.join(os.path.dirname(get_db_path()), CATALOG_SEED_FILE), encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Table definitions, formatted with the table name so the money migration can build
+# replacement tables from the exact same DDL as a fresh database
+_TABLE_DDL = {
+    "catalog": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            category TEXT,
+            price_cents INTEGER NOT NULL,
+            brand TEXT,
+            size TEXT,
+            units TEXT,
+            tags TEXT -- JSON encoded list
+        )
+    """,
+    "orders": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            order_id TEXT PRIMARY KEY,
+            timestamp TEXT,
+            total_cents INTEGER,
+            customer_name TEXT,
+            address TEXT,
+            status TEXT DEFAULT 'received',
+            created_at TEXT DEFAULT (datetime('now')),
+            updated_at TEXT DEFAULT (datetime('now'))
+        )
+    """,
+    "order_items": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT,
+            item_id TEXT,
+            name TEXT,
+            unit_price_cents INTEGER,
+            quantity INTEGER,
+            notes TEXT,
+            FOREIGN KEY(order_id) REFERENCES orders(order_id) ON DELETE CASCADE
+        )
+    """,
+}
+
+
+def _migrate_money_to_cents(conn: sqlite3.Connection):
+    """Convert REAL money columns from databases created before schema version 2 to INTEGER cents.
+    Each affected table is rebuilt from _TABLE_DDL (new table, copy, drop, rename), so a migrated
+    database ends up with the same columns and constraints as a fresh one."""
+    renames = (("catalog", "price", "price_cents"), ("orders", "total", "total_cents"), ("order_items", "unit_price", "unit_price_cents"))
+    # dropping the old orders table must not cascade into order_items; the pragma is
+    # ignored inside a transaction, so it is switched off around it
+    conn.execute("PRAGMA foreign_keys = OFF;")
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for table, old, new in renames:
+                columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if old not in columns:
+                    continue
+                rebuilt = f"{table}_cents"
+                conn.execute(_TABLE_DDL[table].format(table=rebuilt))
+                target = [row[1] for row in conn.execute(f"PRAGMA table_info({rebuilt})")]
+                source = [f"CAST(ROUND({old} * 100) AS INTEGER)" if col == new else col for col in target]
+                conn.execute(f"INSERT INTO {rebuilt} ({', '.join(target)}) SELECT {', '.join(source)} FROM {table}")
+                conn.execute(f"DROP TABLE {table}")
+                conn.execute(f"ALTER TABLE {rebuilt} RENAME TO {table}")
+                logger.info("Migrated %s.%s to integer cents", table, old)
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
+
+
+def seed_database() -> bool:
+    """Create tables and seed the Venezuelan catalog if empty, then load the catalog cache.
+    Returns False if either step failed. A failed seed still loads whatever the catalog table
+    holds (e.g. rows another process already wrote); a failed load leaves the cache empty."""
+    ok = True
     try:
+        # runs once at startup, before any tool or simulation task can touch the DB
         conn = get_conn()
-        cur = conn.cursor()
-
-        # Create catalog table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS catalog (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                category TEXT,
-                price REAL NOT NULL,
-                brand TEXT,
-                size TEXT,
-                units TEXT,
-                tags TEXT -- JSON encoded list
-            )
-        """)
-
-        # Orders table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                order_id TEXT PRIMARY KEY,
-                timestamp TEXT,
-                total REAL,
-                customer_name TEXT,
-                address TEXT,
-                status TEXT DEFAULT 'received',
-                created_at TEXT DEFAULT (datetime('now')),
-                updated_at TEXT DEFAULT (datetime('now'))
-            )
-        """)
-
-        # Order items
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS order_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id TEXT,
-                item_id TEXT,
-                name TEXT,
-                unit_price REAL,
-                quantity INTEGER,
-                notes TEXT,
-                FOREIGN KEY(order_id) REFERENCES orders(order_id) ON DELETE CASCADE
-            )
-        """)
-
-        # Check if catalog empty
-        cur.execute("SELECT COUNT(1) FROM catalog")
-        if cur.fetchone()[0] == 0:
-            catalog = [
-                # Básicos Venezolanos
-                ("harina-de-maiz-pan-1kg", "Harina de Maíz PAN", "Básicos", 1.80, "PAN", "1kg", "paquete", json.dumps(["harina", "arepas", "hallacas"])),
-                ("arroz-blanco-1kg", "Arroz Granulado Tipo 1", "Básicos", 1.50, "Mary", "1kg", "paquete", json.dumps(["arroz", "pabellon"])),
-                ("azucar-1kg", "Azúcar Refinada", "Básicos", 1.20, "Montalban", "1kg", "paquete", json.dumps(["dulce", "basico"])),
-                ("sal-1kg", "Sal Marina", "Básicos", 0.80, "Refisal", "1kg", "paquete", json.dumps(["basico", "condimento"])),
-                ("aceite-vegetal-1l", "Aceite Comestible", "Básicos", 3.50, "Vatel", "1L", "botella", json.dumps(["cocina", "fritura"])),
-                
-                # Lácteos y Similares
-                ("leche-completa-1l", "Leche Completa", "Lácteos", 2.10, "Lácteos Los Andes", "1L", "cartón", json.dumps(["lacteo", "basico"])),
-                ("queso-blanco-rallado-500g", "Queso Blanco Rallado", "Lácteos", 6.50, "Santa Bárbara", "500g", "paquete", json.dumps(["queso", "arepas", "basico"])),
-                ("mantequilla-250g", "Margarina con Sal", "Lácteos", 2.50, "Mavesa", "250g", "barra", json.dumps(["lacteo"])),
-                
-                # Carnes (Simuladas - Precios por 500g o unidad)
-                ("carne-de-res-500g", "Carne de Res de Primera", "Carnes", 8.00, "", "500g", "bandeja", json.dumps(["carne", "hallacas"])),
-                ("pernil-de-cerdo-500g", "Pernil de Cerdo Fresco", "Carnes", 6.50, "", "500g", "bandeja", json.dumps(["carne", "hallacas"])),
-                ("gallina-entera", "Gallina Criolla Entera", "Carnes", 12.00, "", "1.5kg", "unidad", json.dumps(["carne", "hallacas"])),
-                ("carne-mechada-500g", "Carne para Pabellón", "Carnes", 7.50, "", "500g", "bandeja", json.dumps(["carne", "pabellon"])),
-                ("redondo-de-res-1kg", "Redondo de Res para Asado", "Carnes", 15.00, "", "1kg", "pieza", json.dumps(["carne", "asado-negro"])),
-                
-                # Condimentos y Extras
-                ("aceite-onotado", "Aceite Onotado", "Condimentos", 4.50, "El Gran Chef", "250ml", "frasco", json.dumps(["hallacas", "color"])),
-                ("hojas-de-platano-paquete", "Hojas de Plátano", "Extras", 3.00, "Frescas", "20unid", "paquete", json.dumps(["hallacas"])),
-                ("pasas-250g", "Pasas Morenas", "Condimentos", 2.00, "La Venezolana", "250g", "paquete", json.dumps(["hallacas", "dulce"])),
-                ("aceitunas-rellenas-frasco", "Aceitunas Rellenas", "Condimentos", 4.00, "Serpis", "300g", "frasco", json.dumps(["hallacas"])),
-                ("papelon-panela", "Papelón en Panela", "Básicos", 1.50, "El Campesino", "500g", "panela", json.dumps(["dulce", "asado-negro"])),
-                ("vegetales-para-sofrito", "Vegetales para Sofrito (Mixto)", "Vegetales", 5.00, "Forum", "500g", "bolsa", json.dumps(["sofrito", "hallacas", "asado-negro"])),
-                ("vino-tinto-seco-375ml", "Vino Tinto Seco", "Licores", 7.00, "Santa Elena", "375ml", "botella", json.dumps(["cocina", "asado-negro"])),
-                ("platano-maduro-unidad", "Plátano Maduro", "Vegetales", 0.75, "", "unidad", "unidad", json.dumps(["pabellon", "fruta"])),
-            ]
-            cur.executemany("""
-                INSERT INTO catalog (id, name, category, price, brand, size, units, tags)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, catalog)
-            conn.commit()
-            logger.info(f"✅ Seeded Venezuelan catalog into {get_db_path()}")
-
-        conn.close()
+        # user_version is stamped once the schema and seed are in place,
+        # so later process starts skip the DDL and the emptiness check entirely
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            _create_schema(conn)
     except Exception as e:
         logger.exception("Failed to seed database: %s", e)
+        ok = False
+    try:
+        load_catalog_cache()
+    except Exception as e:
+        # e.g. "no such table" when the schema could not be created at all
+        logger.exception("Failed to load the catalog cache: %s", e)
+        return False
+    return ok
+
+
+def _create_schema(conn: sqlite3.Connection):
+    """Migrate, create tables and indexes, and seed the catalog for databases below SCHEMA_VERSION."""
+    _migrate_money_to_cents(conn)
+    cur = conn.cursor()
 
+    for table, ddl in _TABLE_DDL.items():
+        cur.execute(ddl.format(table=table))
+
+    # Indexes for order lookups: history by customer (matches the LOWER() filter
+    # and created_at ordering in list_orders_db), unfiltered recent history, and items by their order
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_orders_lower_cust_created ON orders(LOWER(customer_name), created_at DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_orders_created_at ON orders(created_at DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items(order_id)")
+
+    # Check if catalog empty. Several prewarmed processes can get here at once on a fresh
+    # database; OR IGNORE lets the ones that lose the race skip rows the winner already wrote.
+    cur.execute("SELECT COUNT(1) FROM catalog")
+    if cur.fetchone()[0] == 0:
+        catalog = [
+            (rec["id"], rec["name"], rec["category"], rec["price_cents"], rec["brand"], rec["size"], rec["units"], json.dumps(rec["tags"]))
+            for rec in load_catalog_seed()
+        ]
+        cur.executemany("""
+            INSERT OR IGNORE INTO catalog (id, name, category, price_cents, brand, size, units, tags)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, catalog)
+        conn.commit()
+        logger.info("✅ Seeded Venezuelan catalog into %s", get_db_path())
+
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+
+# The catalog is read-only once seeded, so it is loaded into memory once per process.
+# Keys are lower-cased ids; the record dicts are shared, callers must not mutate them.
+_CATALOG_BY_ID: Dict[str, dict] = {}
+
+# Search indexes over the cached catalog, keyed by lower-cased id:
+# lower-cased name / raw tags text (what the old LIKE scans matched against),
+# catalog position (to keep rowid order), exact tag -> ids, trigram -> ids.
+_SEARCH_TEXT: Dict[str, Tuple[str, str]] = {}
+_CATALOG_POS: Dict[str, int] = {}
+_TAG_INDEX: Dict[str, Set[str]] = {}
+_NAME_TRIGRAMS: Dict[str, Set[str]] = {}
+_TAGS_TRIGRAMS: Dict[str, Set[str]] = {}
 
-# Seed DB on import/run (safe to call multiple times)
-seed_database()
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def load_catalog_cache():
+    """(Re)load the whole catalog into _CATALOG_BY_ID and the search indexes, parsing tags once."""
+    rows = get_conn().execute("SELECT * FROM catalog ORDER BY rowid").fetchall()
+    records = []
+    for r in rows:
+        rec = dict(r)
+        try:
+            rec["tags"] = json.loads(rec.get("tags") or "[]")
+        except Exception:
+            rec["tags"] = []
+        records.append(rec)
+    _CATALOG_BY_ID.clear()
+    _CATALOG_BY_ID.update((rec["id"].lower(), rec) for rec in records)
+
+    for index in (_SEARCH_TEXT, _CATALOG_POS, _TAG_INDEX, _NAME_TRIGRAMS, _TAGS_TRIGRAMS):
+        index.clear()
+    for pos, (r, rec) in enumerate(zip(rows, records)):
+        key = rec["id"].lower()
+        name_lc = (rec["name"] or "").lower()
+        tags_lc = (r["tags"] or "").lower()
+        _SEARCH_TEXT[key] = (name_lc, tags_lc)
+        _CATALOG_POS[key] = pos
+        for tag in rec["tags"]:
+            _TAG_INDEX.setdefault(str(tag).lower(), set()).add(key)
+        for gram in _trigrams(name_lc):
+            _NAME_TRIGRAMS.setdefault(gram, set()).add(key)
+        for gram in _trigrams(tags_lc):
+            _TAGS_TRIGRAMS.setdefault(gram, set()).add(key)
+
+    _RECIPE_ITEMS.clear()
+    _RECIPE_ITEMS.update((dish, tuple(find_catalog_items_by_ids(ids))) for dish, ids in RECIPE_MAP.items())
+
+
+_DB_READY = threading.Event()
+
+
+def ensure_database():
+    """Seed the DB and load the catalog cache once per process (normally from prewarm)."""
+    if _DB_READY.is_set():
+        return
+    with _DB_LOCK:
+        # a failed seed is retried by the next call (entrypoint calls this again)
+        if not _DB_READY.is_set() and seed_database():
+            _DB_READY.set()
+
+# slots=True needs Python 3.10+; fall back to plain dataclasses on 3.9
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
 # In-memory per-session cart
-@dataclass
+@dataclass(**_DATACLASS_SLOTS)
 class CartItem:
     item_id: str
     name: str
-    unit_price: float
+    unit_price_cents: int
     quantity: int = 1
     notes: str = ""
 
-@dataclass
+@dataclass(**_DATACLASS_SLOTS)
 class Userdata:
-    cart: List[CartItem] = field(default_factory=list)
+    # keyed by lower-cased item id; dicts keep insertion order for display
+    cart: Dict[str, CartItem] = field(default_factory=dict)
+    # running sum of line totals in integer cents, adjusted by every cart mutation
+    total_cents: int = 0
     customer_name: Optional[str] = None
+    # orders placed in this session; the job's shutdown hook stops only their simulations
+    placed_orders: Set[str] = field(default_factory=set)
 
 # DB Helpers
 
 def find_catalog_item_by_id_db(item_id: str) -> Optional[dict]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM catalog WHERE LOWER(id) = LOWER(?) LIMIT 1", (item_id,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    record = dict(row)
-    try:
-        record["tags"] = json.loads(record.get("tags") or "[]")
-    except Exception:
-        record["tags"] = []
-    return record
+    return _CATALOG_BY_ID.get(item_id.lower())
+
+
+def find_catalog_items_by_ids(item_ids: List[str]) -> List[dict]:
+    """Resolve a batch of ids in one pass over the cache, keeping order and skipping unknown ids."""
+    get = _CATALOG_BY_ID.get
+    return [item for item in (get(iid.lower()) for iid in item_ids) if item is not None]
+
+
+def _substring_matches(q: str, column: int, trigram_index: Dict[str, Set[str]]) -> Set[str]:
+    """Ids whose name (column 0) or tags text (column 1) contains q; trigrams narrow the candidates first."""
+    if len(q) < 3:
+        candidates = _SEARCH_TEXT.keys()
+    else:
+        postings = [trigram_index.get(gram) for gram in _trigrams(q)]
+        if not all(postings):
+            return set()
+        candidates = set.intersection(*postings)
+    return {key for key in candidates if q in _SEARCH_TEXT[key][column]}
+
+
+def _in_catalog_order(keys: Set[str], limit: int) -> List[dict]:
+    return [_CATALOG_BY_ID[k] for k in sorted(keys, key=_CATALOG_POS.__getitem__)[:limit]]
 
 
 def search_catalog_by_name_db(query: str) -> List[dict]:
-    q = f"%{query.lower()}%"
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT * FROM catalog
-        WHERE LOWER(name) LIKE ? OR LOWER(tags) LIKE ?
-        LIMIT 50
-    """, (q, q))
-    rows = cur.fetchall()
-    conn.close()
-    results = []
-    for r in rows:
-        rec = dict(r)
-        try:
-            rec["tags"] = json.loads(rec.get("tags") or "[]")
-        except Exception:
-            rec["tags"] = []
-        results.append(rec)
-    return results
+    q = query.lower()
+    keys = _substring_matches(q, 0, _NAME_TRIGRAMS) | _substring_matches(q, 1, _TAGS_TRIGRAMS)
+    return _in_catalog_order(keys, 50)
 
 
-def insert_order_db(order_id: str, timestamp: str, total: float, customer_name: str, address: str, status: str, items: List[CartItem]):
+def insert_order_db(order_id: str, total_cents: int, customer_name: str, address: str, status: str, items: List[CartItem]):
+    item_rows = [(order_id, ci.item_id, ci.name, ci.unit_price_cents, ci.quantity, ci.notes) for ci in items]
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO orders (order_id, timestamp, total, customer_name, address, status, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
-    """, (order_id, timestamp, total, customer_name, address, status))
-    for ci in items:
-        cur.execute("""
-            INSERT INTO order_items (order_id, item_id, name, unit_price, quantity, notes)
+    # header and items go in together: take the write lock up front, commit once (or roll back)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            INSERT INTO orders (order_id, timestamp, total_cents, customer_name, address, status, created_at, updated_at)
+            VALUES (?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), ?, ?, ?, ?, datetime('now'), datetime('now'))
+        """, (order_id, total_cents, customer_name, address, status))
+        conn.executemany("""
+            INSERT INTO order_items (order_id, item_id, name, unit_price_cents, quantity, notes)
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (order_id, ci.item_id, ci.name, ci.unit_price, ci.quantity, ci.notes))
-    conn.commit()
-    conn.close()
+        """, item_rows)
+
+
+# order_items columns, selected with an "i_" prefix so they don't clash with orders.*
+_ORDER_ITEM_COLUMNS = ("id", "order_id", "item_id", "name", "unit_price_cents", "quantity", "notes")
+_ORDER_WITH_ITEMS_SQL = f"""
+    SELECT o.*, {", ".join(f"i.{c} AS i_{c}" for c in _ORDER_ITEM_COLUMNS)}
+    FROM orders o LEFT JOIN order_items i ON i.order_id = o.order_id
+    WHERE o.order_id = ?
+    ORDER BY i.id
+"""
 
 
 def get_order_db(order_id: str) -> Optional[dict]:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM orders WHERE order_id = ? LIMIT 1", (order_id,))
-    o = cur.fetchone()
-    if not o:
-        conn.close()
+    """Fetch an order header plus its items with one LEFT JOIN."""
+    rows = get_conn().execute(_ORDER_WITH_ITEMS_SQL, (order_id,)).fetchall()
+    if not rows:
         return None
-    order = dict(o)
-    cur.execute("SELECT * FROM order_items WHERE order_id = ?", (order_id,))
-    items = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    order["items"] = items
+    order = {k: rows[0][k] for k in rows[0].keys() if not k.startswith("i_")}
+    # an order without items still yields one row, with NULL item columns
+    order["items"] = [{c: r[f"i_{c}"] for c in _ORDER_ITEM_COLUMNS} for r in rows if r["i_id"] is not None]
     return order
 
 
 def list_orders_db(limit: int = 10, customer_name: Optional[str] = None) -> List[dict]:
     conn = get_conn()
-    cur = conn.cursor()
     if customer_name:
-        cur.execute("SELECT * FROM orders WHERE LOWER(customer_name) = LOWER(?) ORDER BY created_at DESC LIMIT ?", (customer_name, limit))
+        rows = conn.execute("SELECT * FROM orders WHERE LOWER(customer_name) = LOWER(?) ORDER BY created_at DESC LIMIT ?", (customer_name, limit)).fetchall()
     else:
-        cur.execute("SELECT * FROM orders ORDER BY created_at DESC LIMIT ?", (limit,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+        rows = conn.execute("SELECT * FROM orders ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(r) for r in rows]
 
 
 def update_order_status_db(order_id: str, new_status: str) -> bool:
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE orders SET status = ?, updated_at = datetime('now') WHERE order_id = ?", (new_status, order_id))
-    changed = cur.rowcount
-    conn.commit()
-    conn.close()
-    return changed > 0
+    with conn:
+        cur = conn.execute("UPDATE orders SET status = ?, updated_at = datetime('now') WHERE order_id = ?", (new_status, order_id))
+    return cur.rowcount > 0
+
+
+def advance_order_statuses_db(updates: List[Tuple[str, str]]) -> Set[str]:
+    """Apply several (order_id, new_status) changes in one UPDATE; returns the order ids that changed.
+    Cancelled orders (from this or another worker process) are left alone."""
+    if not updates:
+        return set()
+    conn = get_conn()
+    with conn:
+        # holding the write lock from the SELECT on, no other process can cancel in between,
+        # so the ids read here are exactly the rows the UPDATE changes
+        conn.execute("BEGIN IMMEDIATE")
+        placeholders = ", ".join(["?"] * len(updates))
+        advanced = {row[0] for row in conn.execute(
+            f"SELECT order_id FROM orders WHERE order_id IN ({placeholders}) AND status != 'cancelled'",
+            [order_id for order_id, _ in updates],
+        )}
+        eligible = [(order_id, status) for order_id, status in updates if order_id in advanced]
+        if eligible:
+            cases = " ".join(["WHEN ? THEN ?"] * len(eligible))
+            placeholders = ", ".join(["?"] * len(eligible))
+            conn.execute(
+                f"UPDATE orders SET status = CASE order_id {cases} END, updated_at = datetime('now') "
+                f"WHERE order_id IN ({placeholders})",
+                [v for pair in eligible for v in pair] + [order_id for order_id, _ in eligible],
+            )
+    return advanced
+
+
+async def _run_db(fn, *args, **kwargs):
+    """Run a blocking DB helper in a worker thread so the event loop keeps serving audio."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+# Every write goes through this one thread (and so one connection): writers queue here
+# instead of contending for the WAL write lock and waiting out SQLITE_BUSY retries.
+_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+
+async def _run_db_write(fn, *args, **kwargs):
+    """Like _run_db, but serialised on the single writer thread."""
+    return await asyncio.get_running_loop().run_in_executor(_WRITE_EXECUTOR, partial(fn, *args, **kwargs))
 
 # LOGIC & ASYNC SIMULATION
 
-RECIPE_MAP = {
-    "hallacas": [
+RECIPE_MAP = MappingProxyType({
+    "hallacas": (
         "harina-de-maiz-pan-1kg",
         "carne-de-res-500g", 
         "pernil-de-cerdo-500g",
@@ -292,100 +481,208 @@ RECIPE_MAP = {
         "hojas-de-platano-paquete",
         "pasas-250g",
         "aceitunas-rellenas-frasco",
-    ],
-    "arepas fritas": [
+    ),
+    "arepas fritas": (
         "harina-de-maiz-pan-1kg", 
         "queso-blanco-rallado-500g", 
         "aceite-vegetal-1l"
-    ],
-    "pabellon criollo": [
+    ),
+    "pabellon criollo": (
         "arroz-blanco-1kg", 
         "caraotas-negras-1kg", 
         "carne-mechada-500g", 
         "platano-maduro-unidad"
-    ],
-    "asado negro": [
+    ),
+    "asado negro": (
         "redondo-de-res-1kg", 
         "papelon-panela", 
         "vegetales-para-sofrito",
         "vino-tinto-seco-375ml"
-    ],
-}
+    ),
+})
 
-# Intelligent ingredient inference helpers
-import re
+# dish -> catalog records for RECIPE_MAP, resolved once by load_catalog_cache (unknown ids dropped)
+_RECIPE_ITEMS: Dict[str, Tuple[dict, ...]] = {}
 
+# Intelligent ingredient inference helpers
 _NUMBER_WORDS = {
     'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
     'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10
 }
 
+# Compiled once at import; these run on every ingredient request
+# "for 3" or "for three": one scan, the first "for <n>" in the utterance wins
+_SERVINGS_RE = re.compile(r"for\s+(?:(\d+)|(" + "|".join(_NUMBER_WORDS) + r")\b)")
+_DISH_RE = re.compile(r"ingredients? for (.+)", re.I)
+_DISH_FALLBACK_RE = re.compile(r"(?:make|for making|get me what i need for|i need) (.+)", re.I)
+_SERVINGS_SUFFIX_RE = re.compile(r"for\s+\w+(?: people| person| persons)?", re.I)
+_WORD_RE = re.compile(r"\w+")
+
 def _parse_servings_from_text(text: str) -> int:
     """Try to extract servings/quantity from informal text like 'for two people' or 'for 3'. Default 1."""
     text = (text or "").lower()
-    m = re.search(r"for\s+(\d+)\s*(?:people|person|servings)?", text)
-    if m:
-        try:
-            return max(1, int(m.group(1)))
-        except Exception:
-            pass
-    for word, num in _NUMBER_WORDS.items():
-        if f"for {word}" in text:
-            return num
-    return 1
+    m = _SERVINGS_RE.search(text)
+    if not m:
+        return 1
+    digits, word = m.groups()
+    return max(1, int(digits)) if digits else _NUMBER_WORDS[word]
 
 
 def _infer_items_from_tags(query: str, max_results: int = 6) -> List[str]:
     """Try to infer catalog items by matching query words to tags in the catalog. Returns list of item_ids."""
-    words = re.findall(r"\w+", (query or "").lower())
+    words = _WORD_RE.findall((query or "").lower())
     found = []
-    conn = get_conn()
-    cur = conn.cursor()
     for w in words:
         if len(found) >= max_results:
             break
-        q = f"%\"{w}\"%"
-        cur.execute("SELECT * FROM catalog WHERE LOWER(tags) LIKE ? OR LOWER(name) LIKE ? LIMIT 10", (q, f"%{w}%"))
-        rows = cur.fetchall()
-        for r in rows:
+        # exact tag match, or the word anywhere in the name
+        keys = _TAG_INDEX.get(w, set()) | _substring_matches(w, 0, _NAME_TRIGRAMS)
+        for r in _in_catalog_order(keys, 10):
             rid = r["id"]
             if rid not in found:
                 found.append(rid)
                 if len(found) >= max_results:
                     break
-    conn.close()
     return found
 
-STATUS_FLOW = ["received", "confirmed", "shipped", "out_for_delivery", "delivered"]
+STATUS_FLOW = ("received", "confirmed", "shipped", "out_for_delivery", "delivered")
+# statuses the simulation advances through (everything after "received")
+_STATUS_TRANSITIONS = STATUS_FLOW[1:]
 
 
-async def simulate_delivery_flow(order_id: str):
-    """
-    Background task: automatically advances order status every 5 seconds.
-    Flow: received -> confirmed -> shipped -> out_for_delivery -> delivered
-    """
-    logger.info(f"🔄 [Simulation] Started tracking simulation for {order_id}")
+# seconds between simulated status transitions
+SIM_STEP_SECONDS = 5
+# seconds before retrying transitions whose batched write failed (e.g. "database is locked")
+SIM_RETRY_SECONDS = 5
 
-    # initial wait
-    await asyncio.sleep(5)
+# One scheduler task per event loop drives the delivery simulation of the orders placed on
+# that loop. With LiveKit's process executor that is one per process; with the thread
+# executor every job runs its own loop, and each gets its own schedule, only ever touched
+# from that loop's thread. Pending transitions live in a min-heap of
+# (due time, order_id, index into _STATUS_TRANSITIONS); each order has at most one entry,
+# its next transition. `orders` holds the orders still being simulated; dropping an id
+# from it stops that order at its next transition.
+@dataclass(**_DATACLASS_SLOTS)
+class _DeliverySchedule:
+    queue: List[Tuple[float, str, int]] = field(default_factory=list)
+    orders: Set[str] = field(default_factory=set)
+    wake: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
 
-    # Loop through statuses starting from index 1 (confirmed)
-    for next_status in STATUS_FLOW[1:]:
-        # Check if order was cancelled in the meantime
-        curr_order = get_order_db(order_id)
-        if curr_order and curr_order.get("status") == "cancelled":
-            logger.info(f"🛑 [Simulation] Order {order_id} was cancelled. Stopping simulation.")
-            return
 
-        update_order_status_db(order_id, next_status)
-        logger.info(f"🚚 [Simulation] Order {order_id} updated to '{next_status}'")
-        await asyncio.sleep(5)
+# a loop's entry is removed by the shutdown hook of the last job with orders on it
+_SIM_SCHEDULES: Dict[asyncio.AbstractEventLoop, _DeliverySchedule] = {}
+_SIM_LOCK = threading.Lock()
 
-    logger.info(f"✅ [Simulation] Order {order_id} simulation complete (Delivered).")
 
+def _loop_schedule() -> _DeliverySchedule:
+    """The running loop's schedule, created on first use."""
+    loop = asyncio.get_running_loop()
+    with _SIM_LOCK:
+        schedule = _SIM_SCHEDULES.get(loop)
+        if schedule is None:
+            schedule = _SIM_SCHEDULES[loop] = _DeliverySchedule()
+    return schedule
+
+
+async def _delivery_scheduler(schedule: _DeliverySchedule):
+    """
+    Background task: automatically advances order status every SIM_STEP_SECONDS.
+    Flow: received -> confirmed -> shipped -> out_for_delivery -> delivered
+    All transitions that are due together are written in one UPDATE.
+    """
+    loop = asyncio.get_running_loop()
+    queue = schedule.queue
+    while queue:
+        delay = queue[0][0] - loop.time()
+        if delay > 0:
+            # sleep until the head is due, or until start_delivery_simulation pushes an earlier one
+            schedule.wake.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(schedule.wake.wait(), timeout=delay)
+            continue
+
+        now = loop.time()
+        due = []
+        while queue and queue[0][0] <= now:
+            due.append(heapq.heappop(queue))
+        try:
+            advanced = await _run_db_write(advance_order_statuses_db, [(oid, _STATUS_TRANSITIONS[step]) for _, oid, step in due])
+        except Exception:
+            # this task drives every order on the loop, so one failed write must not end it
+            logger.exception("[Simulation] Failed to advance %d order(s); retrying in %ss", len(due), SIM_RETRY_SECONDS)
+            retry_at = loop.time() + SIM_RETRY_SECONDS
+            for _, order_id, step in due:
+                heapq.heappush(queue, (retry_at, order_id, step))
+            continue
 
-def cart_total(cart: List[CartItem]) -> float:
-    return round(sum(ci.unit_price * ci.quantity for ci in cart), 2)
+        for due_at, order_id, step in due:
+            if order_id not in advanced:
+                logger.info("🛑 [Simulation] Order %s was cancelled. Stopping simulation.", order_id)
+                schedule.orders.discard(order_id)
+                continue
+            logger.info("🚚 [Simulation] Order %s updated to '%s'", order_id, _STATUS_TRANSITIONS[step])
+            if step + 1 >= len(_STATUS_TRANSITIONS):
+                logger.info("✅ [Simulation] Order %s simulation complete (Delivered).", order_id)
+                schedule.orders.discard(order_id)
+            elif order_id in schedule.orders:
+                heapq.heappush(queue, (due_at + SIM_STEP_SECONDS, order_id, step + 1))
+
+
+def start_delivery_simulation(order_id: str):
+    """Queue an order's first transition, starting the running loop's scheduler task if needed."""
+    logger.info("🔄 [Simulation] Started tracking simulation for %s", order_id)
+    schedule = _loop_schedule()
+    due_at = asyncio.get_running_loop().time() + SIM_STEP_SECONDS
+    heapq.heappush(schedule.queue, (due_at, order_id, 0))
+    schedule.orders.add(order_id)
+    if schedule.task is None or schedule.task.done():
+        schedule.task = asyncio.create_task(_delivery_scheduler(schedule))
+    elif schedule.queue[0][1] == order_id:
+        schedule.wake.set()
+
+
+async def cancel_delivery_simulations(order_ids: Set[str]):
+    """Shutdown hook for one job: drop the pending transitions of the orders it placed.
+    Other sessions' orders keep advancing; the loop's scheduler is stopped once none are left."""
+    loop = asyncio.get_running_loop()
+    schedule = _SIM_SCHEDULES.get(loop)
+    if schedule is None:
+        return
+    schedule.orders.difference_update(order_ids)
+    schedule.queue[:] = [entry for entry in schedule.queue if entry[1] in schedule.orders]
+    heapq.heapify(schedule.queue)
+    if schedule.orders:
+        # the head may have been dropped; let the scheduler re-read its sleep time
+        schedule.wake.set()
+        return
+    with _SIM_LOCK:
+        del _SIM_SCHEDULES[loop]
+    task = schedule.task
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def cart_total(userdata: Userdata) -> float:
+    """Cart total in currency units for display; the cents value is what gets stored."""
+    return userdata.total_cents / 100
+
+
+def _add_to_cart(userdata: Userdata, item: dict, quantity: int, notes: str = "") -> Tuple[CartItem, bool]:
+    """Add a catalog item or bump the existing line. Returns the cart line and whether it already existed."""
+    key = item["id"].lower()
+    ci = userdata.cart.get(key)
+    if ci is not None:
+        ci.quantity += quantity
+        if notes:
+            ci.notes = notes
+        userdata.total_cents += ci.unit_price_cents * quantity
+        return ci, True
+    ci = CartItem(item_id=item["id"], name=item["name"], unit_price_cents=item["price_cents"], quantity=quantity, notes=notes)
+    userdata.cart[key] = ci
+    userdata.total_cents += ci.unit_price_cents * quantity
+    return ci, False
 
 # Agent Tools
 @function_tool
@@ -398,8 +695,9 @@ async def find_item(
         return f"No items found matching '{query}'. Try generic names like 'leche' or 'arroz'."
     lines = []
     for it in matches[:10]:
-        lines.append(f"- {it['name']} (id: {it['id']}) — {CURRENCY_SYMBOL}{it['price']:.2f} — {it.get('size','')}")
-    return "Found:\n" + "\n".join(lines)
+        lines.append(f"- {it['name']} (id: {it['id']}) — {CURRENCY_SYMBOL}{it['price_cents'] / 100:.2f} — {it.get('size','')}")
+    listing = "\n".join(lines)
+    return f"Found:\n{listing}"
 
 
 @function_tool
@@ -413,35 +711,33 @@ async def add_to_cart(
     if not item:
         return f"Item id '{item_id}' not found."
 
-    for ci in ctx.userdata.cart:
-        if ci.item_id.lower() == item_id.lower():
-            ci.quantity += quantity
-            if notes:
-                ci.notes = notes
-            total = cart_total(ctx.userdata.cart)
-            # CAMBIO DE MONEDA: ₹ a $
-            return f"Updated '{ci.name}' quantity to {ci.quantity}. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
-
-    ci = CartItem(item_id=item["id"], name=item["name"], unit_price=float(item["price"]), quantity=quantity, notes=notes)
-    ctx.userdata.cart.append(ci)
-    total = cart_total(ctx.userdata.cart)
+    ci, existed = _add_to_cart(ctx.userdata, item, quantity, notes)
+    total = cart_total(ctx.userdata)
+    if existed:
+        # CAMBIO DE MONEDA: ₹ a $
+        return f"Updated '{ci.name}' quantity to {ci.quantity}. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
+
     # CAMBIO DE MONEDA: ₹ a $
     return f"Added {quantity} x '{item['name']}' to cart. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
 
 
+def _remove_from_cart(userdata: Userdata, item_id: str) -> str:
+    """Shared by remove_from_cart and update_cart_quantity, so internal callers skip the tool wrapper."""
+    ci = userdata.cart.pop(item_id.lower(), None)
+    if ci is None:
+        return f"Item '{item_id}' was not in your cart."
+    userdata.total_cents -= ci.unit_price_cents * ci.quantity
+    total = cart_total(userdata)
+    # CAMBIO DE MONEDA: ₹ a $
+    return f"Removed item '{item_id}' from cart. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
+
+
 @function_tool
 async def remove_from_cart(
     ctx: RunContext[Userdata],
     item_id: Annotated[str, Field(description="Catalog item id to remove")],
 ) -> str:
-    before = len(ctx.userdata.cart)
-    ctx.userdata.cart = [ci for ci in ctx.userdata.cart if ci.item_id.lower() != item_id.lower()]
-    after = len(ctx.userdata.cart)
-    if before == after:
-        return f"Item '{item_id}' was not in your cart."
-    total = cart_total(ctx.userdata.cart)
-    # CAMBIO DE MONEDA: ₹ a $
-    return f"Removed item '{item_id}' from cart. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
+    return _remove_from_cart(ctx.userdata, item_id)
 
 
 @function_tool
@@ -451,14 +747,15 @@ async def update_cart_quantity(
     quantity: Annotated[int, Field(description="New quantity")],
 ) -> str:
     if quantity < 1:
-        return await remove_from_cart(ctx, item_id)
-    for ci in ctx.userdata.cart:
-        if ci.item_id.lower() == item_id.lower():
-            ci.quantity = quantity
-            total = cart_total(ctx.userdata.cart)
-            # CAMBIO DE MONEDA: ₹ a $
-            return f"Updated '{ci.name}' quantity to {ci.quantity}. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
-    return f"Item '{item_id}' not found in cart."
+        return _remove_from_cart(ctx.userdata, item_id)
+    ci = ctx.userdata.cart.get(item_id.lower())
+    if ci is None:
+        return f"Item '{item_id}' not found in cart."
+    ctx.userdata.total_cents += ci.unit_price_cents * (quantity - ci.quantity)
+    ci.quantity = quantity
+    total = cart_total(ctx.userdata)
+    # CAMBIO DE MONEDA: ₹ a $
+    return f"Updated '{ci.name}' quantity to {ci.quantity}. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
 
 
 @function_tool
@@ -466,12 +763,13 @@ async def show_cart(ctx: RunContext[Userdata]) -> str:
     if not ctx.userdata.cart:
         return "Your cart is empty."
     lines = []
-    for ci in ctx.userdata.cart:
+    for ci in ctx.userdata.cart.values():
         # CAMBIO DE MONEDA: ₹ a $
-        lines.append(f"- {ci.quantity} x {ci.name} @ {CURRENCY_SYMBOL}{ci.unit_price:.2f} each = {CURRENCY_SYMBOL}{ci.unit_price * ci.quantity:.2f}")
-    total = cart_total(ctx.userdata.cart)
+        lines.append(f"- {ci.quantity} x {ci.name} @ {CURRENCY_SYMBOL}{ci.unit_price_cents / 100:.2f} each = {CURRENCY_SYMBOL}{ci.unit_price_cents * ci.quantity / 100:.2f}")
+    total = cart_total(ctx.userdata)
     # CAMBIO DE MONEDA: ₹ a $
-    return "Your cart:\n" + "\n".join(lines) + f"\nTotal: {CURRENCY_SYMBOL}{total:.2f}"
+    listing = "\n".join(lines)
+    return f"Your cart:\n{listing}\nTotal: {CURRENCY_SYMBOL}{total:.2f}"
 
 
 @function_tool
@@ -485,22 +783,11 @@ async def add_recipe(
         available_dishes = ', '.join(f"'{d}'" for d in RECIPE_MAP.keys())
         return f"Sorry, I don't have a recipe for '{dish_name}'. Try one of these: {available_dishes}."
     added = []
-    for item_id in RECIPE_MAP[key]:
-        item = find_catalog_item_by_id_db(item_id)
-        if not item:
-            continue
-
-        found = False
-        for ci in ctx.userdata.cart:
-            if ci.item_id.lower() == item_id.lower():
-                ci.quantity += 1
-                found = True
-                break
-        if not found:
-            ctx.userdata.cart.append(CartItem(item_id=item["id"], name=item["name"], unit_price=float(item["price"]), quantity=1))
+    for item in _RECIPE_ITEMS.get(key, ()):
+        _add_to_cart(ctx.userdata, item, 1)
         added.append(item["name"])
 
-    total = cart_total(ctx.userdata.cart)
+    total = cart_total(ctx.userdata)
     # CAMBIO DE MONEDA: ₹ a $
     return f"Added ingredients for '{dish_name}': {', '.join(added)}. Cart total: {CURRENCY_SYMBOL}{total:.2f}"
 
@@ -517,44 +804,33 @@ async def ingredients_for(
     servings = _parse_servings_from_text(text)
 
     # try to extract a dish phrase after common verbs
-    m = re.search(r"ingredients? for (.+)", text, re.I)
+    m = _DISH_RE.search(text)
     if m:
         dish = m.group(1)
     else:
-        m2 = re.search(r"(?:make|for making|get me what i need for|i need) (.+)", text, re.I)
+        m2 = _DISH_FALLBACK_RE.search(text)
         dish = m2.group(1) if m2 else text
 
     # remove trailing 'for X people' fragments
-    dish = re.sub(r"for\s+\w+(?: people| person| persons)?", "", dish, flags=re.I).strip()
+    dish = _SERVINGS_SUFFIX_RE.sub("", dish).strip()
     key = dish.lower()
 
-    item_ids = []
     if key in RECIPE_MAP:
-        item_ids = RECIPE_MAP[key]
+        items = _RECIPE_ITEMS.get(key, ())
     else:
-        item_ids = _infer_items_from_tags(dish)
+        items = find_catalog_items_by_ids(_infer_items_from_tags(dish))
 
-    if not item_ids:
+    if not items:
         # Actualizado para sugerir artículos venezolanos
         return f"Sorry, I couldn't determine ingredients for '{request}'. Try a simpler phrase like 'queso' or 'arepas'."
 
     added = []
-    for iid in item_ids:
-        item = find_catalog_item_by_id_db(iid)
-        if not item:
-            continue
+    for item in items:
         # add with servings as quantity
-        found = False
-        for ci in ctx.userdata.cart:
-            if ci.item_id.lower() == iid.lower():
-                ci.quantity += servings
-                found = True
-                break
-        if not found:
-            ctx.userdata.cart.append(CartItem(item_id=item['id'], name=item['name'], unit_price=float(item['price']), quantity=servings))
+        _add_to_cart(ctx.userdata, item, servings)
         added.append(item['name'])
 
-    total = cart_total(ctx.userdata.cart)
+    total = cart_total(ctx.userdata)
     # CAMBIO DE MONEDA: ₹ a $
     return f"I've added {', '.join(added)} to your cart for '{dish}'. (Servings: {servings}). Cart total: {CURRENCY_SYMBOL}{total:.2f}"
 
@@ -568,27 +844,29 @@ async def place_order(
     if not ctx.userdata.cart:
         return "Your cart is empty."
 
-    order_id = str(uuid.uuid4())[:8]
-    now = datetime.utcnow().isoformat() + "Z"
-    total = cart_total(ctx.userdata.cart)
+    order_id = secrets.token_hex(4)
+    total = cart_total(ctx.userdata)
 
-    # 1. Persist to DB
-    insert_order_db(order_id=order_id, timestamp=now, total=total, customer_name=customer_name, address=address, status="received", items=ctx.userdata.cart)
+    # 1. Take and clear the cart before awaiting: LiveKit runs a turn's tool calls concurrently,
+    #    so anything added while the order is being written goes into the next cart
+    items = list(ctx.userdata.cart.values())
+    total_cents = ctx.userdata.total_cents
+    ctx.userdata.cart.clear()
+    ctx.userdata.total_cents = 0
 
-    # 2. Clear Cart
-    ctx.userdata.cart = []
+    # 2. Persist to DB; on failure merge the lines back so the customer loses nothing
+    try:
+        await _run_db_write(insert_order_db, order_id=order_id, total_cents=total_cents, customer_name=customer_name, address=address, status="received", items=items)
+    except Exception:
+        for ci in items:
+            _add_to_cart(ctx.userdata, {"id": ci.item_id, "name": ci.name, "price_cents": ci.unit_price_cents}, ci.quantity, ci.notes)
+        raise
     ctx.userdata.customer_name = customer_name
+    ctx.userdata.placed_orders.add(order_id)
 
     # 3. Trigger Background Simulation (Received -> Shipped -> Out for delivery...)
-    try:
-        # create a background task on the running event loop
-        asyncio.create_task(simulate_delivery_flow(order_id))
-    except RuntimeError:
-        # If there is no running loop, schedule on a new loop in a background thread
-        loop = asyncio.new_event_loop()
-        asyncio.get_running_loop() if asyncio.get_event_loop().is_running() else None
-        # fire-and-forget: run in background
-        asyncio.get_event_loop().call_soon_threadsafe(lambda: asyncio.create_task(simulate_delivery_flow(order_id)))
+    # tools run on the session's event loop, so there is always a running loop here
+    start_delivery_simulation(order_id)
 
     # CAMBIO DE MONEDA: ₹ a $
     return f"Order placed successfully! Order ID: {order_id}. Total: {CURRENCY_SYMBOL}{total:.2f}. I have initiated express shipping; the status will update automatically shortly."
@@ -599,7 +877,7 @@ async def cancel_order(
     ctx: RunContext[Userdata],
     order_id: Annotated[str, Field(description="Order ID to cancel")],
 ) -> str:
-    o = get_order_db(order_id)
+    o = await _run_db(get_order_db, order_id)
     if not o:
         return f"No order found with id {order_id}."
 
@@ -611,7 +889,7 @@ async def cancel_order(
         return f"Order {order_id} is already cancelled."
 
     # Update DB
-    update_order_status_db(order_id, "cancelled")
+    await _run_db_write(update_order_status_db, order_id, "cancelled")
     return f"Order {order_id} has been cancelled successfully."
 
 
@@ -620,7 +898,7 @@ async def get_order_status(
     ctx: RunContext[Userdata],
     order_id: Annotated[str, Field(description="Order ID to check")],
 ) -> str:
-    o = get_order_db(order_id)
+    o = await _run_db(get_order_db, order_id)
     if not o:
         return f"No order found with id {order_id}."
     return f"Order {order_id} status: {o.get('status', 'unknown')}. Updated at: {o.get('updated_at')}"
@@ -631,23 +909,20 @@ async def order_history(
     ctx: RunContext[Userdata],
     customer_name: Annotated[Optional[str], Field(description="Optional customer name to filter", default=None)] = None,
 ) -> str:
-    rows = list_orders_db(limit=5, customer_name=customer_name)
+    rows = await _run_db(list_orders_db, limit=5, customer_name=customer_name)
     if not rows:
         return "No orders found."
     lines = []
     for o in rows:
         # CAMBIO DE MONEDA: ₹ a $
-        lines.append(f"- {o['order_id']} | {CURRENCY_SYMBOL}{o['total']:.2f} | Status: {o.get('status')}")
-    prefix = "Recent Orders"
-    if customer_name:
-        prefix += f" for {customer_name}"
-    return prefix + ":\n" + "\n".join(lines)
+        lines.append(f"- {o['order_id']} | {CURRENCY_SYMBOL}{o['total_cents'] / 100:.2f} | Status: {o.get('status')}")
+    prefix = f"Recent Orders for {customer_name}" if customer_name else "Recent Orders"
+    listing = "\n".join(lines)
+    return f"{prefix}:\n{listing}"
 
 # Agent Definition
-class FoodAgent(Agent):
-    def __init__(self):
-        super().__init__(
-    instructions="""
+# Built once at import so every session shares the same (byte-identical) prompt
+FOOD_AGENT_INSTRUCTIONS = """
     You are **Marielena**, a highly professional, friendly, and enthusiastic AI voice shopping assistant for **'Forum Supermayoristas'**, the major Venezuelan supermarket chain.
     
     **Primary Goal:** Help the customer quickly and easily find ingredients, get recipe lists, and manage their shopping cart using only voice commands.
@@ -670,11 +945,20 @@ class FoodAgent(Agent):
         * You can **CANCEL** an order if the user asks, provided it's not delivered yet (use `cancel_order`).
         * If the user asks "Where is my order?" (¿Dónde está mi pedido?), use `get_order_status` to check the status. Since the status advances automatically (simulated), encourage them to check back in a few seconds.
         * Use `order_history` to retrieve past orders.
-    """,
-    tools=[find_item, add_to_cart, remove_from_cart, update_cart_quantity, show_cart, add_recipe, place_order, cancel_order, get_order_status, order_history],
-)
+    """
+
+FOOD_AGENT_TOOLS = [find_item, add_to_cart, remove_from_cart, update_cart_quantity, show_cart, add_recipe, place_order, cancel_order, get_order_status, order_history]
+
+
+class FoodAgent(Agent):
+    def __init__(self):
+        super().__init__(instructions=FOOD_AGENT_INSTRUCTIONS, tools=FOOD_AGENT_TOOLS)
+
 
 def prewarm(proc: JobProcess):
+    # open the persistent connection, seed and load the catalog before the first job arrives
+    ensure_database()
+
     # load VAD model and stash on process userdata
     try:
         proc.userdata["vad"] = silero.VAD.load()
@@ -687,29 +971,47 @@ async def entrypoint(ctx: JobContext):
     logger.info("\n" + "🇻🇪" * 12)
     logger.info("🚀 STARTING Marielena (Venezuelan Context + Auto-Tracking)")
 
+    ensure_database()  # no-op when prewarm already ran in this process
     userdata = Userdata()
 
+    async def stop_order_simulations():
+        await cancel_delivery_simulations(userdata.placed_orders)
+
+    ctx.add_shutdown_callback(stop_order_simulations)
+
     session = AgentSession(
-        stt=deepgram.STT(model="nova-3"),
+        stt=deepgram.STT(model="nova-3", sample_rate=16000),
         llm=google.LLM(model="gemini-2.5-flash"),
         tts=murf.TTS(
             voice="es-MX-luisa",
             style="Conversational",
+            # flush each sentence to TTS as soon as it is complete (default tokenizer waits for 20 chars)
+            tokenizer=tokenize.basic.SentenceTokenizer(min_sentence_len=2),
             text_pacing=True,
         ),
         turn_detection=MultilingualModel(),
         vad=ctx.proc.userdata.get("vad"),
         userdata=userdata,
+        # start LLM inference on the interim transcript, before end-of-turn is confirmed
+        preemptive_generation=True,
     )
 
-    await session.start(
-        agent=FoodAgent(),
-        room=ctx.room,
-        room_input_options=RoomInputOptions(noise_cancellation=noise_cancellation.BVC()),
+    # independent handshakes: start the session pipeline while the room connection comes up
+    # (JobContext.connect() is idempotent, so it doesn't matter which side connects first)
+    await asyncio.gather(
+        session.start(
+            agent=FoodAgent(),
+            room=ctx.room,
+            room_input_options=RoomInputOptions(
+                noise_cancellation=noise_cancellation.BVC(),
+                # capture mic audio as 16 kHz mono, the rate Deepgram is fed at, so it is resampled only once
+                audio_sample_rate=16000,
+                audio_num_channels=1,
+            ),
+        ),
+        ctx.connect(),
     )
 
-    await ctx.connect()
-
 
 if __name__ == "__main__":
     cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
@@ -0,0 +1,27 @@
+import shutil
+import threading
+from pathlib import Path
+
+import pytest
+
+import agent
+
+SRC_DIR = Path(agent.__file__).parent
+
+
+@pytest.fixture
+def db_dir(tmp_path, monkeypatch):
+    """Point the agent's SQLite helpers at an empty directory holding only the seed catalog."""
+    shutil.copy(SRC_DIR / agent.CATALOG_SEED_FILE, tmp_path)
+    monkeypatch.setattr(agent, "get_db_path", lambda: str(tmp_path / agent.DB_FILE))
+    monkeypatch.setattr(agent, "_TLS", threading.local())
+    monkeypatch.setattr(agent, "_DB_READY", threading.Event())
+    monkeypatch.setattr(agent, "_WAL_ENABLED", False)
+    opened_before = len(agent._ALL_CONNS)
+    yield tmp_path
+    # close the connections of every thread (including the writer) that opened one during the test
+    with agent._DB_LOCK:
+        opened = agent._ALL_CONNS[opened_before:]
+        del agent._ALL_CONNS[opened_before:]
+    for conn in opened:
+        conn.close()
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import agent
+
+QUERIES = [
+    "", "a", "pa", "pan", "queso", "QUESO", "arro", "hallacas", "maíz", "carne",
+    "de", "asado-negro", "asado", "negro", "o", "lacteo", '"', "zz", "tinto seco",
+    "Plátano", "aceite", "1kg", "ba", "ase", "s", "e",
+]
+
+
+@pytest.fixture
+def catalog(db_dir):
+    agent.ensure_database()
+    return agent.get_conn()
+
+
+def _like_search(conn, query):
+    """The SQL search find_item used before the in-memory index."""
+    q = f"%{query.lower()}%"
+    rows = conn.execute(
+        "SELECT id FROM catalog WHERE LOWER(name) LIKE ? OR LOWER(tags) LIKE ? LIMIT 50", (q, q)
+    ).fetchall()
+    return [r["id"] for r in rows]
+
+
+def _like_infer(conn, query, max_results):
+    """The SQL tag inference used before the in-memory index."""
+    found = []
+    for w in agent._WORD_RE.findall(query.lower()):
+        if len(found) >= max_results:
+            break
+        rows = conn.execute(
+            "SELECT id FROM catalog WHERE LOWER(tags) LIKE ? OR LOWER(name) LIKE ? LIMIT 10",
+            (f'%"{w}"%', f"%{w}%"),
+        ).fetchall()
+        for r in rows:
+            if r["id"] not in found:
+                found.append(r["id"])
+                if len(found) >= max_results:
+                    break
+    return found
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_search_matches_like_query(catalog, query):
+    assert [it["id"] for it in agent.search_catalog_by_name_db(query)] == _like_search(catalog, query)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+@pytest.mark.parametrize("max_results", [1, 3, 6])
+def test_infer_matches_like_query(catalog, query, max_results):
+    text = f"{query} arepas con queso para carne"
+    assert agent._infer_items_from_tags(text, max_results) == _like_infer(catalog, text, max_results)
+
+
+def test_search_returns_parsed_tags(catalog):
+    (item,) = agent.search_catalog_by_name_db("harina")
+    assert item["tags"] == json.loads(catalog.execute("SELECT tags FROM catalog WHERE id = ?", (item["id"],)).fetchone()[0])
+
+
+@pytest.mark.parametrize("query", ["%", "_", "q_eso"])
+def test_like_wildcards_are_matched_literally(catalog, query):
+    # LIKE treated these as wildcards ("%" listed the whole catalog); the index matches plain substrings
+    assert _like_search(catalog, query)
+    assert agent.search_catalog_by_name_db(query) == []
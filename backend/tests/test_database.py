@@ -0,0 +1,136 @@
+import sqlite3
+
+import agent
+
+# schema written by databases created before money moved to integer cents (user_version 0)
+LEGACY_SCHEMA = """
+    CREATE TABLE catalog (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        category TEXT,
+        price REAL NOT NULL,
+        brand TEXT,
+        size TEXT,
+        units TEXT,
+        tags TEXT
+    );
+    CREATE TABLE orders (
+        order_id TEXT PRIMARY KEY,
+        timestamp TEXT,
+        total REAL,
+        customer_name TEXT,
+        address TEXT,
+        status TEXT DEFAULT 'received',
+        created_at TEXT DEFAULT (datetime('now')),
+        updated_at TEXT DEFAULT (datetime('now'))
+    );
+    CREATE TABLE order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id TEXT,
+        item_id TEXT,
+        name TEXT,
+        unit_price REAL,
+        quantity INTEGER,
+        notes TEXT,
+        FOREIGN KEY(order_id) REFERENCES orders(order_id) ON DELETE CASCADE
+    );
+"""
+
+
+def _write_legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany(
+        "INSERT INTO catalog (id, name, category, price, brand, size, units, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            ("harina-de-maiz-pan-1kg", "Harina PAN", "Granos", 2.5, "PAN", "1kg", "pack", '["arepa"]'),
+            ("queso-blanco-rallado-500g", "Queso Blanco", "Lácteos", 4.35, "Local", "500g", "pack", '["queso"]'),
+            ("aceite-vegetal-1l", "Aceite", "Despensa", 0.29, "Mazeite", "1L", "bottle", "[]"),
+        ],
+    )
+    conn.execute("INSERT INTO orders (order_id, timestamp, total, customer_name, address, status) VALUES ('a1b2c3d4', 't', 9.2, 'Ana', 'Caracas', 'delivered')")
+    conn.executemany(
+        "INSERT INTO order_items (order_id, item_id, name, unit_price, quantity, notes) VALUES ('a1b2c3d4', ?, ?, ?, ?, '')",
+        [("harina-de-maiz-pan-1kg", "Harina PAN", 2.5, 2), ("queso-blanco-rallado-500g", "Queso Blanco", 4.2, 1)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def _schema(conn, table):
+    return {
+        "columns": [tuple(r) for r in conn.execute(f"PRAGMA table_info({table})")],
+        "foreign_keys": [tuple(r) for r in conn.execute(f"PRAGMA foreign_key_list({table})")],
+        "indexes": sorted(r[1] for r in conn.execute(f"PRAGMA index_list({table})")),
+    }
+
+
+def test_migrates_real_money_columns_to_cents(db_dir):
+    _write_legacy_db(db_dir / agent.DB_FILE)
+
+    agent.ensure_database()
+
+    assert agent._DB_READY.is_set()
+    conn = agent.get_conn()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == agent.SCHEMA_VERSION
+    assert dict(conn.execute("SELECT id, price_cents FROM catalog").fetchall()) == {
+        "harina-de-maiz-pan-1kg": 250,
+        "queso-blanco-rallado-500g": 435,
+        "aceite-vegetal-1l": 29,
+    }
+    # the orders table is rebuilt too; its items must not be cascade-deleted with it
+    order = agent.get_order_db("a1b2c3d4")
+    assert order["total_cents"] == 920
+    assert [(i["item_id"], i["unit_price_cents"], i["quantity"]) for i in order["items"]] == [
+        ("harina-de-maiz-pan-1kg", 250, 2),
+        ("queso-blanco-rallado-500g", 420, 1),
+    ]
+    # existing catalog rows are kept, the seed only fills an empty catalog
+    assert agent.find_catalog_item_by_id_db("aceite-vegetal-1l")["price_cents"] == 29
+    assert len(agent._CATALOG_BY_ID) == 3
+
+
+def test_migrated_schema_matches_fresh_schema(db_dir):
+    _write_legacy_db(db_dir / agent.DB_FILE)
+    agent.ensure_database()
+
+    fresh = sqlite3.connect(":memory:")
+    agent._create_schema(fresh)
+    for table in agent._TABLE_DDL:
+        assert _schema(agent.get_conn(), table) == _schema(fresh, table), table
+    assert agent.get_conn().execute("PRAGMA foreign_key_check").fetchall() == []
+
+
+def test_migrated_order_items_keep_autoincrement(db_dir):
+    _write_legacy_db(db_dir / agent.DB_FILE)
+    agent.ensure_database()
+
+    items = [agent.CartItem(item_id="aceite-vegetal-1l", name="Aceite", unit_price_cents=29)]
+    agent.insert_order_db("e5f6a7b8", 29, "Ana", "Caracas", "received", items)
+    assert [i["id"] for i in agent.get_order_db("e5f6a7b8")["items"]] == [3]
+
+
+def test_fresh_database_is_seeded(db_dir):
+    assert agent.seed_database()
+    assert len(agent._CATALOG_BY_ID) == len(agent.load_catalog_seed())
+    assert agent._RECIPE_ITEMS.keys() == agent.RECIPE_MAP.keys()
+    assert all(agent._RECIPE_ITEMS.values())
+
+
+def test_missing_seed_file_is_reported_not_raised(db_dir):
+    (db_dir / agent.CATALOG_SEED_FILE).unlink()
+
+    assert not agent.seed_database()
+    agent.ensure_database()
+    assert not agent._DB_READY.is_set()
+
+
+def test_failed_schema_creation_is_reported_not_raised(db_dir, monkeypatch):
+    def locked(conn):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(agent, "_create_schema", locked)
+    # no catalog table at all, so the cache load fails too
+    assert not agent.seed_database()
+    agent.ensure_database()
+    assert not agent._DB_READY.is_set()
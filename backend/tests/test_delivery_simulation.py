@@ -0,0 +1,113 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import agent
+
+
+@pytest.fixture
+async def orders(db_dir, monkeypatch):
+    monkeypatch.setattr(agent, "SIM_STEP_SECONDS", 0.01)
+    monkeypatch.setattr(agent, "SIM_RETRY_SECONDS", 0.01)
+    agent.ensure_database()
+    items = [agent.CartItem(item_id="aceite-vegetal-1l", name="Aceite", unit_price_cents=350)]
+    for order_id in ("order-a", "order-b"):
+        agent.insert_order_db(order_id, 350, "Ana", "Caracas", "received", items)
+    yield ("order-a", "order-b")
+    schedule = agent._SIM_SCHEDULES.get(asyncio.get_running_loop())
+    if schedule is not None:
+        await agent.cancel_delivery_simulations(set(schedule.orders))
+
+
+async def _wait_for_status(order_ids, status, timeout=5):
+    async def poll():
+        while any(agent.get_order_db(oid)["status"] != status for oid in order_ids):
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def test_orders_advance_to_delivered(orders):
+    for order_id in orders:
+        agent.start_delivery_simulation(order_id)
+    await _wait_for_status(orders, "delivered")
+
+
+async def test_cancelled_order_stops_advancing(orders):
+    agent.update_order_status_db("order-a", "cancelled")
+    for order_id in orders:
+        agent.start_delivery_simulation(order_id)
+    await _wait_for_status(["order-b"], "delivered")
+    assert agent.get_order_db("order-a")["status"] == "cancelled"
+
+
+async def test_failed_write_is_retried(orders, monkeypatch):
+    advance = agent.advance_order_statuses_db
+    failures = []
+
+    def flaky_advance(updates):
+        if not failures:
+            failures.append(updates)
+            raise sqlite3.OperationalError("database is locked")
+        return advance(updates)
+
+    monkeypatch.setattr(agent, "advance_order_statuses_db", flaky_advance)
+    for order_id in orders:
+        agent.start_delivery_simulation(order_id)
+    await _wait_for_status(orders, "delivered")
+    assert failures
+
+
+async def test_shutdown_stops_only_that_sessions_orders(orders, monkeypatch):
+    # slow enough that polling sees "confirmed" before the next step
+    monkeypatch.setattr(agent, "SIM_STEP_SECONDS", 0.05)
+    for order_id in orders:
+        agent.start_delivery_simulation(order_id)
+    await _wait_for_status(["order-a"], "confirmed")
+
+    # session A disconnects; session B's order must keep advancing
+    await agent.cancel_delivery_simulations({"order-a"})
+    await _wait_for_status(["order-b"], "delivered")
+    # a write already in flight at shutdown may still land one more step
+    assert agent.get_order_db("order-a")["status"] in ("confirmed", "shipped")
+    schedule = agent._SIM_SCHEDULES[asyncio.get_running_loop()]
+    assert schedule.orders == set()
+    assert schedule.queue == []
+
+    # the last session on the loop shutting down removes the loop's schedule
+    await agent.cancel_delivery_simulations({"order-b"})
+    assert asyncio.get_running_loop() not in agent._SIM_SCHEDULES
+
+
+async def test_sessions_on_separate_loops_are_independent(orders, monkeypatch):
+    # LiveKit's thread executor runs each job on its own event loop in one process
+    monkeypatch.setattr(agent, "SIM_STEP_SECONDS", 0.05)
+    errors = []
+
+    async def session(order_id, shut_down_early):
+        agent.start_delivery_simulation(order_id)
+        if shut_down_early:
+            await _wait_for_status([order_id], "confirmed")
+            await agent.cancel_delivery_simulations({order_id})
+        else:
+            await _wait_for_status([order_id], "delivered")
+            await agent.cancel_delivery_simulations({order_id})
+
+    def run(*args):
+        try:
+            asyncio.run(session(*args))
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=("order-a", True)), threading.Thread(target=run, args=("order-b", False))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert agent.get_order_db("order-a")["status"] in ("confirmed", "shipped")
+    assert agent.get_order_db("order-b")["status"] == "delivered"
+    assert agent._SIM_SCHEDULES == {}